@@ -1,4 +1,6 @@
 import argparse
+import concurrent.futures
+import functools
 import logging
 import random
 import time
@@ -60,6 +62,12 @@ def parse_args():
         required=False,
         help="Job number.",
     )
+    parser.add_argument(
+        "--nthreads",
+        type=int,
+        default=16,
+        help="Number of checksum threads per job (default=16).",
+    )
     parser.add_argument(
         "--log",
         type=str,
@@ -99,52 +107,43 @@ def getchecksum(path):
     return size, adler32_digest
 
 
-dsmap = dict()
-
-
-def map_to_rucio(ref: DatasetRef) -> str:
-    # global dsmap
-
-    dstype = ref.datasetType.name
-    dims = ref.datasetType.dimensions
-    data_id = ref.dataId
-    massive = "tract" in dims and "visit" in dims
-
-    if (dstype, massive) in dsmap:
-        base = dsmap[(dstype, massive)]
-    elif dstype.endswith("_config") or dstype in ("skyMap"):
-        base = dsmap[(dstype, massive)] = "Configuration"
+@functools.lru_cache(maxsize=None)
+def rucio_base(dstype: str, massive: bool, calib: bool) -> str:
+    """Return the Rucio Dataset base name for a dataset type."""
+    if dstype.endswith("_config") or dstype in ("skyMap"):
+        return "Configuration"
     elif dstype.endswith("_log"):
         if massive:
-            base = dsmap[(dstype, massive)] = "Provenance/" + dstype.removesuffix(
-                "_log"
-            )
-        else:
-            base = dsmap[(dstype, massive)] = "Provenance"
+            return "Provenance/" + dstype.removesuffix("_log")
+        return "Provenance"
     elif dstype.endswith("_metadata"):
         if massive:
-            base = dsmap[(dstype, massive)] = "Provenance/" + dstype.removesuffix(
-                "_metadata"
-            )
-        else:
-            base = dsmap[(dstype, massive)] = "Provenance"
-    elif "/calib/" in ref.run:
-        base = dsmap[(dstype, massive)] = "Calibration"
+            return "Provenance/" + dstype.removesuffix("_metadata")
+        return "Provenance"
+    elif calib:
+        return "Calibration"
     elif "_consolidated_map_" in dstype:
-        base = dsmap[(dstype, massive)] = "Map"
+        return "Map"
     elif "_image" in dstype or "_coadd" in dstype or "_background" in dstype:
-        base = dsmap[(dstype, massive)] = "Image/" + dstype
+        return "Image/" + dstype
     elif (
         "object" in dstype
         or "source" in dstype
         or "table" in dstype
         or "summary" in dstype
     ):
-        base = dsmap[(dstype, massive)] = "Catalog/" + dstype
+        return "Catalog/" + dstype
     elif dstype.startswith("the_monster_"):
-        base = dsmap[(dstype, massive)] = "ReferenceCatalog"
-    else:
-        base = dsmap[(dstype, massive)] = dstype
+        return "ReferenceCatalog"
+    return dstype
+
+
+def map_to_rucio(ref: DatasetRef) -> str:
+    dstype = ref.datasetType.name
+    dims = ref.datasetType.dimensions
+    data_id = ref.dataId
+    massive = "tract" in dims and "visit" in dims
+    base = rucio_base(dstype, massive, "/calib/" in ref.run)
 
     if "tract" in dims:
         if dstype in ("dia_object", "dia_source", "object"):
@@ -164,6 +163,58 @@ def map_to_rucio(ref: DatasetRef) -> str:
     return "Dataset/" + rucio_dataset
 
 
+def add_replicas(files, pathmap, dstype):
+    """Checksum and register the files that have no replica at the RSE."""
+    if not config.dry_run and len(files) > 0:
+        # The pre-check is worth its round-trip: it avoids checksumming
+        # files that are already registered.
+        present = replica_client.list_replicas(
+            [{"scope": did["scope"], "name": did["name"]} for did in files],
+            rse_expression=config.rse,
+        )
+        existing_names = {replica["name"] for replica in present}
+        files = [did for did in files if did["name"] not in existing_names]
+        checksums = checksum_pool.map(
+            getchecksum, [pathmap[did["name"]] for did in files]
+        )
+        for did, (size, adler32) in zip(files, checksums):
+            did["bytes"], did["adler32"] = size, adler32
+        if len(files) > 0:
+            retry(
+                "add replicas",
+                replica_client.add_replicas,
+                rse=config.rse,
+                files=files,
+            )
+    logger.info(f"add replica : {len(files)} dstype {dstype.name}")
+
+
+def attach_to_datasets(dstype, final):
+    """Add pending DIDs to their respective Datasets.
+
+    Datasets with more than 500 pending DIDs are flushed, or all of them
+    if ``final`` is set.  Files already in a Dataset are skipped by the
+    server, so its content need not be listed first.
+    """
+    for rucio_dataset, pending in rucio_datasets.items():
+        if len(pending) > 500 or (final and len(pending) > 0):
+            retry(
+                f"add files to {rucio_dataset}",
+                did_client.attach_dids_to_dids,
+                attachments=[
+                    {
+                        "scope": config.scope,
+                        "name": rucio_dataset,
+                        "dids": pending,
+                        "rse": config.rse,
+                    }
+                ],
+                ignore_duplicate=True,
+            )
+            logger.info(f"attach to dataset : {len(pending)} dstype {dstype.name}")
+            rucio_datasets[rucio_dataset] = []
+
+
 config = parse_args()
 # Initialize the logger and set the level
 CliLog.initLog(longlog=True)
@@ -176,10 +227,23 @@ if not config.dry_run:
     did_client = DIDClient()
 butler = Butler(config.repo)
 root = butler._datastore.root
+checksum_pool = concurrent.futures.ThreadPoolExecutor(max_workers=config.nthreads)
 
 n_files = dict()
 rucio_datasets = dict()
 
+# Fetch the names of all existing Datasets once rather than probing each.
+existing_datasets = set()
+if not config.dry_run:
+    existing_datasets = retry(
+        "Dataset list",
+        lambda: set(
+            did_client.list_dids(
+                config.scope, filters={"name": "Dataset/*"}, did_type="dataset"
+            )
+        ),
+    )
+
 dataset_type_list = sorted(
     retry("DSType query", butler.registry.queryDatasetTypes, config.dstype)
 )
@@ -196,19 +260,18 @@ for i, dstype in enumerate(dataset_type_list):
 
     files = []
     pathmap = {}
-    ref_list = sorted(
-        retry(
-            f"DSRef query {dstype.name}",
-            butler.query_datasets,
-            dstype,
-            collections=config.collection,
-            find_first=False,
-            limit=None,
-            explain=False,
-        )
+    ref_list = retry(
+        f"DSRef query {dstype.name}",
+        butler.query_datasets,
+        dstype,
+        collections=config.collection,
+        find_first=False,
+        limit=None,
+        explain=False,
     )
-    for j, ref in enumerate(ref_list):
-        if config.njobs and j % config.njobs != config.jobnum:
+    for ref in ref_list:
+        # Shard on the dataset UUID, which is stable without sorting.
+        if config.njobs and ref.id.int % config.njobs != config.jobnum:
             continue
 
         path = butler.getURI(ref)
@@ -227,21 +290,18 @@ for i, dstype in enumerate(dataset_type_list):
 
         # If the Dataset is new, register it, and set up dict entries.
         if rucio_dataset not in rucio_datasets:
-            try:
-                if not config.dry_run:
-                    _ = did_client.get_did(config.scope, rucio_dataset)
-            except rucio.common.exception.DataIdentifierNotFound:
+            if not config.dry_run and rucio_dataset not in existing_datasets:
                 try:
                     logger.info(f"Creating dataset {config.scope}:{rucio_dataset}")
-                    if not config.dry_run:
-                        did_client.add_dataset(
-                            config.scope,
-                            rucio_dataset,
-                            statuses={"monotonic": True},
-                            rse=config.rse,
-                        )
+                    did_client.add_dataset(
+                        config.scope,
+                        rucio_dataset,
+                        statuses={"monotonic": True},
+                        rse=config.rse,
+                    )
                 except rucio.common.exception.DataIdentifierAlreadyExists:
                     pass
+                existing_datasets.add(rucio_dataset)
             rucio_datasets[rucio_dataset] = []
             n_files[rucio_dataset] = 0
 
@@ -261,56 +321,17 @@ for i, dstype in enumerate(dataset_type_list):
         n_files[rucio_dataset] += 1
         rucio_datasets[rucio_dataset].append(did)
 
-        # when (len(ref_list) - j) <= config.njobs, this one is the last of the
-        # current "for j, ref in enumerate(ref_list):" iteration for this
-        # config.njobs and config.jobnum combination. So everything much be
-        # pushed to Rucio
-        if len(files) >= 500 or (len(ref_list) - j) <= config.njobs:
-            if not config.dry_run:
-                present = replica_client.list_replicas(
-                    files,
-                    rse_expression=config.rse,
-                )
-                existing_names = {replica["name"] for replica in present}
-                files = [did for did in files if did["name"] not in existing_names]
-                for did in files:
-                    did["bytes"], did["adler32"] = getchecksum(pathmap[did["name"]])
-                if len(files) > 0:
-                    retry(
-                        "add replicas",
-                        replica_client.add_replicas,
-                        rse=config.rse,
-                        files=files,
-                    )
-            logger.info(f"add replica : {len(files)} dstype {dstype.name}")
+        if len(files) >= 500:
+            add_replicas(files, pathmap, dstype)
             files = []
             pathmap = {}
+            if not config.dry_run:
+                attach_to_datasets(dstype, final=False)
 
-            # Add all pending DIDs to their respective datasets
-            if config.dry_run:
-                continue
-            for rucio_dataset_i in rucio_datasets:
-                if len(rucio_datasets[rucio_dataset_i]) > 500 or (len(ref_list) - j) <= config.njobs:
-                    present = did_client.list_content(
-                        scope=config.scope, name=rucio_dataset_i
-                    )
-                    existing_names = {did["name"] for did in present}
-                    needed = [
-                        did
-                        for did in rucio_datasets[rucio_dataset_i]
-                        if did["name"] not in existing_names
-                    ]
-                    if len(needed) > 0:
-                        retry(
-                            f"add files to {rucio_dataset}",
-                            did_client.add_files_to_dataset,
-                            scope=config.scope,
-                            name=rucio_dataset_i,
-                            files=needed,
-                            rse=config.rse,
-                        )
-                    logger.info(f"attach to dataset : {len(needed)} dstype {dstype.name}")
-                    rucio_datasets[rucio_dataset_i] = []
+    # Everything left for this job and dataset type must be pushed to Rucio.
+    add_replicas(files, pathmap, dstype)
+    if not config.dry_run:
+        attach_to_datasets(dstype, final=True)
 
 for rucio_dataset in rucio_datasets:
     logger.info(f"{rucio_dataset} has {n_files[rucio_dataset]} files")
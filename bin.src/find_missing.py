@@ -23,12 +23,15 @@
 
 import click
 import collections
+import concurrent.futures
 import json
 import random
 import re
 import subprocess
 import sys
 
+import numpy as np
+
 from lsst.daf.butler import Butler
 from lsst.resources import ResourcePath
 
@@ -51,6 +54,14 @@ CONFIG = {
 }
 
 
+# Camera controllers, normal "O" first.
+CONTROLLERS = ("O", "C", "P", "S")
+SEQNUM_RE = re.compile(r"_([0-9]{6})$")
+# Fraction of FITS files randomly checked with fitsverify.
+VERIFY_RATE = 2e-5
+find_detector = re.compile(r"R[0-4][0-4]_S[0-4GW][0-4]").search
+
+
 @click.command()
 @click.argument("instrument", required=True, type=click.Choice(list(CONFIG.keys())))
 @click.argument("dayobs", type=int, required=True)
@@ -60,17 +71,68 @@ def run(instrument: str, dayobs: int):
 
 def diff(expected_set, found_set, ingested_set):
     """Output the differences between the three sets of detectors."""
-    for det in sorted(expected_set):
+    # Only the detectors that will be reported need sorting.
+    for det in sorted(expected_set - (found_set & ingested_set)):
         if det not in found_set:
             print(f"{det} not sent")
-        elif det not in ingested_set:
+        else:
             print(f"{det} not ingested")
-    for det in sorted(found_set):
-        if det not in expected_set and det not in ingested_set:
-            print(f"{det} unexpected, not ingested")
-    for det in sorted(ingested_set):
-        if det not in found_set:
-            print(f"{det} ingested but not found")
+    for det in sorted(found_set - expected_set - ingested_set):
+        print(f"{det} unexpected, not ingested")
+    for det in sorted(ingested_set - found_set):
+        print(f"{det} ingested but not found")
+
+
+def read_expected_sensors(es_path):
+    """Return the science and guider detectors from an expectedSensors file."""
+    expected_sensors = json.loads(es_path.read())["expectedSensors"]
+    expected_detectors = {
+        d for d in expected_sensors if expected_sensors[d] == "SCIENCE"
+    }
+    expected_guiders = {
+        d for d in expected_sensors if expected_sensors[d] == "GUIDER"
+    }
+    return expected_detectors, expected_guiders
+
+
+def group_by_seqnum(data_ids, detector_names):
+    """Group ingested detector names by exposure sequence number.
+
+    ``detector_names`` is an array of names indexed by detector ID.
+    """
+    ids = np.array(
+        [(data_id["exposure"], data_id["detector"]) for data_id in data_ids],
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    seqnums = ids[:, 0] % 100000
+    names = detector_names[ids[:, 1]]
+    order = np.argsort(seqnums, kind="stable")
+    unique_seqnums, starts = np.unique(seqnums[order], return_index=True)
+    grouped = collections.defaultdict(set)
+    for seqnum, group in zip(
+        unique_seqnums.tolist(), np.split(names[order], starts[1:])
+    ):
+        grouped[seqnum] = set(group)
+    return grouped
+
+
+def list_day(day_path, bucket):
+    """List every file under the observation day in one flat listing.
+
+    Returns a dict mapping each observation ID to the filenames in its
+    directory.  `bucket` is the S3 bucket name, without any profile.
+    Omitting the delimiter lets S3 return the whole tree in pages of 1000
+    keys instead of requiring one LIST per directory.
+    """
+    listing = collections.defaultdict(list)
+    prefix = day_path.relativeToPathRoot
+    paginator = day_path.client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            obs_id, _, filename = obj["Key"][len(prefix):].partition("/")
+            if filename:
+                listing[obs_id].append(filename)
+    return listing
 
 
 def main(instrument, dayobs):
@@ -80,13 +142,14 @@ def main(instrument, dayobs):
 
     # Find the largest sequence number for the observation day.
     day_path = ResourcePath(f"s3://{bucket}/{instrument}/{dayobs}/")
-    for dirpath, dirnames, filenames in day_path.walk():
-        if len(dirnames) > 0:
-            max_seq = int(sorted(dirnames)[-1][-7:-1])
-            break
-    else:
+    listing = list_day(day_path, bucket.rpartition("@")[2])
+    seqnums = [
+        int(m.group(1)) for m in map(SEQNUM_RE.search, listing) if m is not None
+    ]
+    if len(seqnums) == 0:
         print(f"No data on {dayobs}")
         sys.exit(1)
+    max_seq = max(seqnums)
 
     butler = Butler(
         butler_alias, instrument=instrument, collections=f"{instrument}/raw/all"
@@ -97,74 +160,91 @@ def main(instrument, dayobs):
         for x in butler.query_dimension_records("detector", instrument=instrument)
     }
 
+    all_detectors = frozenset(detector_dict.values())
+    detector_names = np.array(
+        [detector_dict.get(i) for i in range(max(detector_dict) + 1)], dtype=object
+    )
+
     # Find the science detector raws and guider raws that have been ingested.
 
-    ingested_detectors = collections.defaultdict(set)
     with butler.query() as q:
-        for data_id in (
+        ingested_detectors = group_by_seqnum(
             q.where(f"day_obs={dayobs}")
             .join_dataset_search("raw")
-            .data_ids(["exposure", "detector"])
-        ):
-            ingested_detectors[data_id["exposure"] % 100000].add(
-                detector_dict[data_id["detector"]]
-            )
+            .data_ids(["exposure", "detector"]),
+            detector_names,
+        )
 
     ingested_guiders = collections.defaultdict(set)
     if instrument == "LSSTCam":
         with butler.query() as q:
-            for data_id in (
+            ingested_guiders = group_by_seqnum(
                 q.where(f"day_obs={dayobs}")
                 .join_dataset_search("guider_raw", f"{instrument}/raw/guider")
-                .data_ids(["exposure", "detector"])
-            ):
-                ingested_guiders[data_id["exposure"] % 100000].add(
-                    detector_dict[data_id["detector"]]
-                )
+                .data_ids(["exposure", "detector"]),
+                detector_names,
+            )
+
+    # Fetch the expectedSensors files concurrently; each is a separate GET.
+    # Only the first controller with files is examined for each sequence
+    # number, so only its file is needed.
+    es_paths = {}
+    for seqnum in range(1, max_seq + 1):
+        for controller in CONTROLLERS:
+            obs_id = f"{obs_prefix}_{controller}_{dayobs}_{seqnum:06d}"
+            if obs_id in listing:
+                es_name = f"{obs_id}_expectedSensors.json"
+                if es_name in listing[obs_id]:
+                    es_paths[obs_id] = day_path.join(
+                        obs_id, forceDirectory=True
+                    ).join(es_name)
+                break
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        expected = dict(
+            zip(es_paths, executor.map(read_expected_sensors, es_paths.values()))
+        )
+
+    # Draw the gaps between randomly verified files up front rather than
+    # rolling the dice for every file.
+    file_idx = 0
+    next_verify = random.expovariate(VERIFY_RATE)
 
     # Check each sequence number to see if it is completely ingested.
     for seqnum in range(1, max_seq + 1):
         print(f"{dayobs=} {seqnum=}", end="")
-        expected_detectors = set(detector_dict.values())
+        expected_detectors = all_detectors
         expected_present = False
         expected_guiders = set()
         found_detectors = set()
         found_guiders = set()
 
         # Need to test for unusual controllers as well as normal "O".
-        for controller in ("O", "C", "P", "S"):
+        for controller in CONTROLLERS:
             obs_id = f"{obs_prefix}_{controller}_{dayobs}_{seqnum:06d}"
-            obs_path = day_path.join(obs_id, forceDirectory=True)
-            filenames = []
-            for dirpath, dirnames, filenames in obs_path.walk():
-                break
+            filenames = listing.get(obs_id, [])
             if len(filenames) == 0:
                 # Nothing with this controller; try the next.
                 continue
-            es_name = f"{obs_id}_expectedSensors.json"
-            if es_name in filenames:
+            obs_path = day_path.join(obs_id, forceDirectory=True)
+            if obs_id in expected:
                 expected_present = True
-                es_path = dirpath.join(es_name)
-                expected_sensors = json.loads(es_path.read())["expectedSensors"]
-                expected_detectors = {
-                    d for d in expected_sensors if expected_sensors[d] == "SCIENCE"
-                }
-                expected_guiders = {
-                    d for d in expected_sensors if expected_sensors[d] == "GUIDER"
-                }
+                expected_detectors, expected_guiders = expected[obs_id]
 
             for f in filenames:
-                if f.endswith(".fits"):
-                    m = re.search(r"R[0-4][0-4]_S[0-4GW][0-4]", f)
-                    detector = m.group(0)
-                    if f.endswith("_guider.fits"):
+                # The last "_" field is e.g. "S11.fits" or "guider.fits".
+                suffix = f.rpartition("_")[2]
+                if suffix.endswith(".fits"):
+                    detector = find_detector(f).group(0)
+                    if suffix == "guider.fits":
                         found_guiders.add(detector)
                     else:
                         found_detectors.add(detector)
 
                     # Randomly run fitsverify on the file.
-                    if random.uniform(0.0, 1.0) < 2e-5:
-                        source_path = dirpath.join(f)
+                    file_idx += 1
+                    if file_idx >= next_verify:
+                        next_verify += random.expovariate(VERIFY_RATE)
+                        source_path = obs_path.join(f)
                         with source_path.as_local() as local:
                             print(" - random fitsverify", end="")
                             try:
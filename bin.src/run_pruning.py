@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
 import fnmatch
+import itertools
 import re
+import threading
 from lsst.daf.butler import Butler
 from lsst.daf.butler.cli.cliLog import CliLog
 import logging
 import time
 import yaml
 
+# Number of concurrent dataset queries issued by prune()
+QUERY_WORKERS = 8
+
 
 def parse_args():
     parser = argparse.ArgumentParser(prog='run_pruning',
@@ -200,16 +206,23 @@ def main():
               logger=logger)
 
 
+def make_matcher(patterns):
+    """Return a function testing a name against any of the glob pattern(s)
+
+    Literal names are tested by set membership; otherwise the patterns are
+    combined into a single compiled regular expression.
+    """
+    if not any(c in p for p in patterns for c in "*?["):
+        return frozenset(patterns).__contains__
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns)).fullmatch
+
+
 def find_matches(dtypes, types_to_match, debug=False, logger=None):
     """ Return a list of dataset types matching specified pattern(s)"""
-    matchlist = []
-    for dstype in types_to_match:
-        robj = re.compile(fnmatch.translate(dstype))
-        dslist = [itype for itype in dtypes if re.fullmatch(robj, itype)]
-        if len(dslist) > 0:
-            if debug:
-                logger.debug(f"dataset types matching {dstype}: {dslist}")
-            matchlist = matchlist + dslist
+    matcher = make_matcher(types_to_match)
+    matchlist = [itype for itype in dtypes if matcher(itype)]
+    if debug and len(matchlist) > 0:
+        logger.debug(f"dataset types matching {types_to_match}: {matchlist}")
     # remove any duplicates, and return as list
     return list(set(matchlist))
 
@@ -217,16 +230,12 @@ def find_matches(dtypes, types_to_match, debug=False, logger=None):
 def find_matches_by_storage_class(dtypes, types_to_match,
                                   debug=False, logger=None):
     """Find dataset types whose storage class matches specified pattern(s)"""
-    matchlist = []
-    for dstype in types_to_match:
-        robj = re.compile(fnmatch.translate(dstype))
-        # dtypes is a list of tuples. The first index is data type name;
-        # the second is storage class.
-        dslist = [itype[0] for itype in dtypes if re.fullmatch(robj, itype[1])]
-        if len(dslist) > 0:
-            if debug:
-                logger.debug(f"dataset types matching {dstype}: {dslist}")
-            matchlist = matchlist + dslist
+    matcher = make_matcher(types_to_match)
+    # dtypes is a list of tuples. The first index is data type name;
+    # the second is storage class.
+    matchlist = [itype[0] for itype in dtypes if matcher(itype[1])]
+    if debug and len(matchlist) > 0:
+        logger.debug(f"dataset types matching {types_to_match}: {matchlist}")
     # remove any duplicates, and return as list
     return list(set(matchlist))
 
@@ -306,25 +315,37 @@ def prune(butler, collection,
     if debug:
         logger.debug(f"List of types to prune: {prune_list}")
 
-    dataset_refs = []
-
     # Some reasonable default
     where_query = "instrument='LSSTCam'"
     if where is not None:
         where_query = where
     if debug:
         logger.debug("where = " + where_query)
-    for dset in prune_list:
-        temp_refs = butler.query_datasets(dataset_type=dset,
-                                          collections=collection,
-                                          where=where_query,
-                                          find_first=False,
-                                          explain=False,
-                                          limit=None,
-                                          )
-        # only take refs with run id that starts with the collection name
-        dataset_refs += [tref for tref in temp_refs
-                         if tref.run.startswith(collection)]
+
+    # A Butler's registry session and caches belong to the instance, so
+    # each query thread works on its own clone of the Butler.
+    local = threading.local()
+
+    def query_refs(dset):
+        if not hasattr(local, "butler"):
+            local.butler = butler.clone()
+        # Iterate over the results page by page instead of materializing
+        # every ref first; only refs in matching runs are kept.
+        with local.butler.query() as query:
+            temp_refs = query.datasets(dset,
+                                       collections=collection,
+                                       find_first=False,
+                                       ).where(where_query)
+            # only take refs with run id that starts with the collection name
+            return [tref for tref in temp_refs
+                    if tref.run.startswith(collection)]
+
+    # The queries are independent and latency-bound, so run them
+    # concurrently.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=QUERY_WORKERS) as executor:
+        dataset_refs = list(itertools.chain.from_iterable(
+            executor.map(query_refs, prune_list)))
 
     dataset_refs.sort()
 
@@ -338,13 +359,16 @@ def prune(butler, collection,
         if debug:
             logger.debug("Found " + str(len(dataset_refs)) + " datset refs to prune.")
         tstart = time.time()
+        # Chunks are pruned one at a time: pruneDatasets empties the whole
+        # datastore trash, and a Butler does not support concurrent
+        # transactions, so a failure stops the pruning at that chunk.
         for chunk in chunked_refs:
             prune_result = butler.pruneDatasets(chunk,
                                                 unstore=True,
                                                 purge=True)
             if debug:
-                logger.debug("Finished a chunk.", flush=True)
-                logger.debug(prune_result, flush=True)
+                logger.debug("Finished a chunk.")
+                logger.debug(prune_result)
         tend = time.time()
         elapsed = tend - tstart
         logger.info(f"Pruning operation finished in {elapsed} seconds.")
@@ -7,12 +7,22 @@
 # where OBS_ID looks like AT_O_20230610_000357
 # You must have a USDF Vault token (be logged in using "vault login").
 
+import collections
+import concurrent.futures
+import functools
+import itertools
+import operator
+import os
 import sys
+import tempfile
+import time
+from pathlib import Path
 
 import requests
 import subprocess
+from requests.adapters import HTTPAdapter
 
-from lsst.daf.butler import Butler, EmptyQueryResultError
+from lsst.daf.butler import Butler
 from lsst.resources import ResourcePath
 
 
@@ -24,16 +34,50 @@ BUCKETS = dict(
     MC="embargo@rubin-summit",
 )
 NAMESPACE = dict(AT="summit-new", CC="summit-new", TS="sts", MC="summit-new")
-OPAQUE = {
-    instrument: subprocess.run(
+OPAQUE_CACHE_DIR = Path.home() / ".cache" / "trigger_ingest"
+OPAQUE_CACHE_TTL = 3600  # seconds
+
+
+@functools.cache
+def load_opaque(namespace):
+    """Return the notification opaque data for a namespace.
+
+    The value is fetched from Vault only when the copy cached on disk is
+    missing, empty or older than OPAQUE_CACHE_TTL.
+    """
+    cache_file = OPAQUE_CACHE_DIR / f"opaque-{namespace}"
+    try:
+        if time.time() - cache_file.stat().st_mtime < OPAQUE_CACHE_TTL:
+            cache_file.chmod(0o600)
+            opaque = cache_file.read_text()
+            if opaque:
+                return opaque
+    except FileNotFoundError:
+        pass
+    opaque = subprocess.run(
         "vault kv get -mount=secret -field=notification"
-        f" rubin/usdf-embargo-dmz/{NAMESPACE[instrument]}".split(" "),
+        f" rubin/usdf-embargo-dmz/{namespace}".split(" "),
         stdout=subprocess.PIPE,
         text=True,
         check=True,
     ).stdout
-    for instrument in NAMESPACE
-}
+    if not opaque:
+        return opaque
+    OPAQUE_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    OPAQUE_CACHE_DIR.chmod(0o700)
+    # Write a private temporary file and rename it into place, so that a
+    # concurrent run never reads a partially written cache.
+    fd, tmp_name = tempfile.mkstemp(dir=OPAQUE_CACHE_DIR, prefix=".opaque-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(opaque)
+        os.replace(tmp_name, cache_file)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return opaque
+
+
 # dev
 # IP=dict(AT="172.24.5.191", CC="172.24.5.191", TS="172.24.5.180",
 # MC="172.24.5.180")
@@ -60,16 +104,61 @@ SENSOR_LIST = dict(
 CORNER_LIST = ["00", "04", "40", "44"]
 CORNER_SENSORS = ["W0", "W1"]
 CORNER_SENSORS.extend(["G0_guider", "G1_guider"])
+SENSOR_KEYS = {
+    instr_code: [
+        f"R{raft}_S{sensor}"
+        for raft in RAFT_LIST[instr_code]
+        for sensor in SENSOR_LIST[instr_code]
+    ]
+    for instr_code in RAFT_LIST
+}
+SENSOR_KEYS["MC"].extend(
+    f"R{raft}_S{sensor}" for raft in CORNER_LIST for sensor in CORNER_SENSORS
+)
+
+
+@functools.cache
+def get_butler(instrument):
+    return Butler(
+        "embargo", instrument=instrument, collections=f"{instrument}/raw/all"
+    )
+
+
+@functools.cache
+def get_detectors(instrument):
+    """Return a mapping of detector ID to full name for an instrument."""
+    return {
+        d.id: d.full_name
+        for d in get_butler(instrument).query_dimension_records("detector")
+    }
 
 
 class Records:
     def __init__(self, bucket, profile=""):
         self._profile = profile
         self._bucket = bucket
-        self._records = []
+        self._candidates = []
 
     def records(self):
-        return self._records
+        """Return the records for candidate objects that exist.
+
+        The candidates for an exposure share a directory, so one listing
+        of it replaces a HEAD request per object.
+        """
+        existing = set()
+        for prefix in {oid.rpartition("/")[0] for oid, _ in self._candidates}:
+            dir_path = ResourcePath(
+                f"s3://{self._profile}{self._bucket}/{prefix}/", forceDirectory=True
+            )
+            for _, _, filenames in dir_path.walk():
+                existing.update(f"{prefix}/{f}" for f in filenames)
+                break
+        records = []
+        for oid, record in self._candidates:
+            if oid in existing:
+                records.append(record)
+                print(oid)
+        return records
 
     def append(self, oid, instr_code):
         record = {
@@ -77,16 +166,56 @@ class Records:
                 "bucket": {"name": self._bucket},
                 "object": {"key": oid},
             },
-            "opaqueData": OPAQUE[instr_code],
+            "opaqueData": load_opaque(NAMESPACE[instr_code]),
         }
-        path = ResourcePath(f"s3://{self._profile}{self._bucket}/{oid}")
-        if path.exists():
-            self._records.append(record)
-            print(oid)
+        self._candidates.append((oid, record))
 
 
+# Parse all the observation IDs first so that the Butler can be queried
+# once per instrument and day rather than once per exposure.
+observations = []
 for obs_id in sys.argv[1:]:
     instr_code, controller, obs_day, seq_num = obs_id.split("_", maxsplit=3)
+    observations.append((instr_code, obs_day, controller, seq_num, obs_id))
+
+# Fetch the opaque data for each namespace needed up front, in parallel,
+# so that the Vault calls overlap instead of running one after another.
+namespaces = {NAMESPACE[obs[0]] for obs in observations}
+with concurrent.futures.ThreadPoolExecutor(max_workers=len(namespaces) or 1) as executor:
+    list(executor.map(load_opaque, namespaces))
+
+ingested_by_exposure = collections.defaultdict(set)
+for (instr_code, obs_day), group in itertools.groupby(
+    sorted(observations), key=operator.itemgetter(0, 1)
+):
+    instrument = INSTRUMENTS[instr_code]
+    seq_nums = sorted({int(obs[3].split("_")[0]) for obs in group})
+    butler = get_butler(instrument)
+    get = get_detectors(instrument).__getitem__
+    where = (
+        f"day_obs={obs_day} and exposure.seq_num IN"
+        f" ({', '.join(str(n) for n in seq_nums)})"
+    )
+    refs = butler.query_datasets("raw", where=where, explain=False)
+    for r in refs:
+        data_id = r.dataId
+        ingested_by_exposure[
+            (instr_code, obs_day, data_id["exposure"] % 100000)
+        ].add(get(data_id["detector"]))
+    refs = butler.query_datasets(
+        "guider_raw",
+        where=where,
+        collections=f"{instrument}/raw/guider",
+        explain=False,
+    )
+    for r in refs:
+        data_id = r.dataId
+        ingested_by_exposure[
+            (instr_code, obs_day, data_id["exposure"] % 100000)
+        ].add(f"{get(data_id['detector'])}_guider")
+
+posts = []
+for instr_code, obs_day, controller, seq_num, obs_id in observations:
     instrument = INSTRUMENTS[instr_code]
     bucket = BUCKETS[instr_code]
     if "@" in bucket:
@@ -96,27 +225,9 @@ for obs_id in sys.argv[1:]:
         profile = ""
 
     records = Records(bucket, profile)
-    butler = Butler(
-        "embargo", instrument=instrument, collections=f"{instrument}/raw/all"
-    )
-    detectors = {d.id: d.full_name for d in butler.query_dimension_records("detector")}
-    try:
-        refs = butler.query_datasets(
-            "raw", where=f"day_obs={obs_day} and exposure.seq_num={seq_num}"
-        )
-        ingested = {detectors[r.dataId["detector"]] for r in refs}
-    except EmptyQueryResultError:
-        ingested = {}
-    try:
-        refs = butler.query_datasets(
-            "guider_raw",
-            where=f"day_obs={obs_day} and exposure.seq_num={seq_num}",
-            collections=f"{instrument}/raw/guider",
-        )
-        for r in refs:
-            ingested.add(detectors[r.dataId["detector"]] + "_guider")
-    except EmptyQueryResultError:
-        pass
+    ingested = ingested_by_exposure[
+        (instr_code, obs_day, int(seq_num.split("_")[0]))
+    ]
 
     if "_" in seq_num:
         seq_num, raft, sensor = seq_num.split("_")
@@ -125,18 +236,18 @@ for obs_id in sys.argv[1:]:
         if not f"{raft}_{sensor}" in ingested:
             records.append(oid, instr_code)
     else:
-        for raft in RAFT_LIST[instr_code]:
-            for sensor in SENSOR_LIST[instr_code]:
-                oid = f"{instrument}/{obs_day}/{obs_id}/{obs_id}_R{raft}_S{sensor}.fits"
-                if not f"R{raft}_S{sensor}" in ingested:
-                    records.append(oid, instr_code)
-        if instrument == "LSSTCam":
-            for raft in CORNER_LIST:
-                for sensor in CORNER_SENSORS:
-                    oid = f"{instrument}/{obs_day}/{obs_id}/{obs_id}_R{raft}_S{sensor}.fits"
-                    if not f"R{raft}_S{sensor}" in ingested:
-                        records.append(oid, instr_code)
+        prefix = f"{instrument}/{obs_day}/{obs_id}/{obs_id}_"
+        for key in SENSOR_KEYS[instr_code]:
+            if key not in ingested:
+                records.append(f"{prefix}{key}.fits", instr_code)
 
     json = {"Records": records.records()}
-    r = requests.post(f"http://{IP[instr_code]}:8080/notify", json=json)
-    print(r.status_code, r)
+    posts.append((f"http://{IP[instr_code]}:8080/notify", json))
+
+# Send the notifications over one pooled session so connections to the
+# enqueue service are kept alive and reused across observations.
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    for r in executor.map(lambda post: session.post(post[0], json=post[1]), posts):
+        print(r.status_code, r)
@@ -22,6 +22,8 @@ XrdCksData struct layout (network / big-endian byte order):
 Total struct size: 96 bytes.
 """
 
+import concurrent.futures
+import mmap
 import os
 import struct
 import sys
@@ -35,17 +37,37 @@ CS_VAL_SIZE = 32
 STRUCT_SIZE = 96
 HEADER_FMT = ">16s q i H H"   # Name(16) fmTime(8) bufSize(4) Flags(2) Length(2)
 HEADER_SIZE = struct.calcsize(HEADER_FMT)   # = 32
-CHUNK_SIZE = 1 << 20           # 1 MiB read buffer
+CHUNK_SIZE = 4 << 20           # 4 MiB read buffer
+MMAP_THRESHOLD = 64 << 20      # mmap files larger than 64 MiB
 
 
 # ── checksum ──────────────────────────────────────────────────────────
 
 def compute_adler32(path: str) -> int:
-    """Stream-compute the adler32 checksum of `path`."""
+    """Stream-compute the adler32 checksum of `path`.
+
+    Large files are mapped and checksummed in a single call, which avoids
+    copying every block into a Python bytes object first.  Smaller files
+    are read one block ahead on a helper thread so that disk reads overlap
+    the checksum; both release the GIL.  Files of a single block have no
+    second read to overlap and are just read in place.
+    """
     checksum = 1
     with open(path, "rb") as fh:
-        while chunk := fh.read(CHUNK_SIZE):
-            checksum = zlib.adler32(chunk, checksum)
+        size = os.fstat(fh.fileno()).st_size
+        if size > MMAP_THRESHOLD:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                return zlib.adler32(mm, checksum) & 0xFFFFFFFF
+        if size <= CHUNK_SIZE:
+            while chunk := fh.read(CHUNK_SIZE):
+                checksum = zlib.adler32(chunk, checksum)
+            return checksum & 0xFFFFFFFF
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+            pending = reader.submit(fh.read, CHUNK_SIZE)
+            while chunk := pending.result():
+                pending = reader.submit(fh.read, CHUNK_SIZE)
+                checksum = zlib.adler32(chunk, checksum)
     return checksum & 0xFFFFFFFF
 
 
@@ -4,14 +4,44 @@ Script to create rules for IDAC release using a config file
 '''
 
 import argparse
+import concurrent.futures
+import functools
+import itertools
 import json
 import textwrap
+import threading
 
 from rucio.client import Client
 from rucio.common.exception import DuplicateRule
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-client = Client(account="release_service")
+
+ACCOUNT = "release_service"
+MAX_WORKERS = 16
+BATCH_SIZE = 500
+
+_local = threading.local()
+
+
+def get_client():
+    """
+    Returns the calling thread's Rucio client, creating it on first use.
+    """
+    if not hasattr(_local, "client"):
+        _local.client = Client(account=ACCOUNT)
+    return _local.client
+
+
+@functools.cache
+def whoami():
+    """
+    Returns the account information for the client, asked for only once.
+    """
+    return get_client().whoami()
 
 
 def parse_arguments():
@@ -61,26 +91,54 @@ def parse_arguments():
     return args
 
 
+def load_json(f):
+    """
+    Parses a JSON file, using orjson when it is available
+    """
+    if orjson is not None:
+        return orjson.loads(f.read())
+    return json.load(f)
+
+
 def load_configuration(containers_file: str):
     with open(containers_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+        data = load_json(f)
     return data
 
 
 def get_container_datasets(did):
-    dids = client.list_content(scope=did['scope'],
-                               name=did['name'])
+    dids = get_client().list_content(scope=did['scope'],
+                                     name=did['name'])
+
+    return ({'scope': d['scope'], 'name': d['name']} for d in dids if d['type'] == 'DATASET')
 
-    to_add = [{'scope': d['scope'], 'name': d['name']} for d in dids if d['type'] == 'DATASET']
 
-    return to_add
+def batched(iterable, n):
+    """
+    Yields lists of up to n items from an iterable
+    """
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
 
 
 def check_rule_exists(rse, scope, name):
-    replicas = client.list_did_rules(scope=scope, name=name)
-    result = filter(lambda x: x['rse_expression'] == rse, replicas)
+    rules = get_client().list_replication_rules(
+        filters={'scope': scope, 'name': name, 'rse_expression': rse}
+    )
 
-    return result
+    return next(iter(rules), None) is not None
+
+
+def add_rule(dids, rse):
+    """
+    Creates a single replication rule covering the given DIDs
+    """
+    return get_client().add_replication_rule(dids=dids,
+                                             copies=1,
+                                             rse_expression=rse,
+                                             activity="IDAC Release",
+                                             asynchronous=True)
 
 
 def main():
@@ -96,13 +154,13 @@ def main():
 
     # open IDAC release json file
     with open(parsed_args.idac_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+        data = load_json(f)
 
     # open data release dataset sizes
     with open(parsed_args.did_file, 'r', encoding='utf-8') as f:
-        release_sizes = json.load(f)
+        release_sizes = load_json(f)
 
-    me = client.whoami()
+    me = whoami()
     print(f"Creating rules for account {me['account']}")
 
     rse = data['rse']
@@ -110,37 +168,48 @@ def main():
         raise Exception("RSE doesn't match config RSE")
     containers = data['containers']
 
-    dids_to_transfer = []
-    skipped = 0
-    for container, enabled in containers.items():
-        if enabled:
-            scope, name = container.split(':')
-            result = check_rule_exists(rse, scope, name)
-            if list(result):
+    enabled_containers = [container.split(':')
+                          for container, enabled in containers.items() if enabled]
+
+    # Rule checks and creations are independent Rucio calls, so overlap them.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        dids_to_transfer = []
+        skipped = 0
+        exists = executor.map(lambda sn: check_rule_exists(rse, *sn), enabled_containers)
+        for (scope, name), rule_exists in zip(enabled_containers, exists):
+            if rule_exists:
                 print(f"replica exists for {scope}:{name} at {rse}, skipping")
                 skipped += 1
             else:
                 print(f"no rules exist at {rse} for {scope}:{name}, will create rule")
                 dids_to_transfer.append({"scope": scope, "name": name})
-    print(f"Rules to create: {len(dids_to_transfer)}, "
-          f"Rules skipped: {skipped}, "
-          f"Total: {len(dids_to_transfer) + skipped}")
-    for did in dids_to_transfer:
-        if release_sizes[f"{did['scope']}:{did['name']}"] > 10000:
-            print("Large container; using datasets")
-            dids = get_container_datasets(did)
-        else:
-            dids = [did]
-        if not parsed_args.dry_run:
+        print(f"Rules to create: {len(dids_to_transfer)}, "
+              f"Rules skipped: {skipped}, "
+              f"Total: {len(dids_to_transfer) + skipped}")
+
+        # Large containers get one rule per batch of their datasets, which
+        # keeps each request and its server-side transaction small.
+        futures = {}
+        for did in dids_to_transfer:
+            large = release_sizes[f"{did['scope']}:{did['name']}"] > 10000
+            if large:
+                print("Large container; using datasets")
+            if parsed_args.dry_run:
+                continue
+            if large:
+                batches = batched(get_container_datasets(did), BATCH_SIZE)
+            else:
+                batches = [[did]]
+            for batch in batches:
+                futures[executor.submit(add_rule, batch, rse)] = did
+        for future in concurrent.futures.as_completed(futures):
+            did = futures[future]
             try:
-                rules_created = client.add_replication_rule(dids=dids,
-                                                            copies=1,
-                                                            rse_expression=rse,
-                                                            activity="IDAC Release",
-                                                            asynchronous=True)
-                print(f"Rule created: {rules_created}")
+                rules_created = future.result()
             except DuplicateRule:
                 print(f"replica exists for {did['scope']}:{did['name']} at {rse}, skipping")
+                continue
+            print(f"Rule created: {rules_created}")
 
 
 if __name__ == "__main__":
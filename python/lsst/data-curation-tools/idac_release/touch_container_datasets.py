@@ -3,35 +3,54 @@
 Script to touch the datasets in a container
 '''
 
+import itertools
+
 from rucio.client import Client
 
 
-client = Client(account="dylee")
+ACCOUNT = "dylee"
+BATCH_SIZE = 1000
+
+_client = None
+
+
+def get_client():
+    '''
+    Returns the Rucio client, creating it on first use
+    '''
+    global _client
+    if _client is None:
+        _client = Client(account=ACCOUNT)
+    return _client
 
 
 def get_datasets(scope: str, name: str):
     '''
     Fetches the datasets for a scope and name
     '''
-    dids = client.list_dids(scope=scope,
-                            filters={'name': name})
+    dids = get_client().list_dids(scope=scope,
+                                  filters={'name': name})
 
     return dids
 
 
-def touch_dataset(scope: str, name: str):
+def touch_datasets(scope: str, names):
     '''
-    Subscription touch a dataset
+    Subscription touch datasets, with one bulk metadata call per batch
     '''
-    client.set_metadata(scope, name, 'is_new', True)
+    names = iter(names)
+    while batch := list(itertools.islice(names, BATCH_SIZE)):
+        for name in batch:
+            print(f'{scope}:{name}')
+        get_client().set_dids_metadata_bulk(
+            dids=[{'scope': scope, 'name': name, 'meta': {'is_new': True}}
+                  for name in batch])
 
 
 def main():
     dids = get_datasets(scope='dp1', name='Dataset/Provenance*')
 
-    for did in dids:
-        print(f'dp1:{did}')
-        touch_dataset(scope='dp1', name=did)
+    touch_datasets(scope='dp1', names=dids)
 
 
 if __name__ == '__main__':
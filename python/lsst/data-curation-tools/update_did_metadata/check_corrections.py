@@ -1,8 +1,22 @@
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def load_json(f):
+    """
+    Parses a JSON file, using orjson when it is available
+    """
+    if orjson is not None:
+        return orjson.loads(f.read())
+    return json.load(f)
+
 
 with open('20251101_corrections.json', 'r', encoding='utf-8') as f:
-    data = json.load(f)
+    data = load_json(f)
 
 
 match = 0
@@ -10,15 +24,9 @@ update = 0
 for did in data:
     old = did['old']
 
-    different = False
-    diff_keys = []
-    for k, v in old.items():
-        if did[k] != v:
-            diff_keys.append(k)
-            different = True
-    if different:
+    if any(did[k] != v for k, v in old.items()):
         print(f"{did['scope']}:{did['name']} is different")
-        print(diff_keys)
+        print([k for k, v in old.items() if did[k] != v])
         update += 1
     else:
         print(f"{did['scope']}:{did['name']} matches")
@@ -6,25 +6,37 @@ Check the status of did replicas
 Copyright 2025 Fermi National Accelerator Laboratory (FNAL)
 """
 import argparse
+import collections
+import concurrent.futures
+import threading
 
 from rucio.client import Client
 
 
-client = Client()
+MAX_WORKERS = 32
 
+_local = threading.local()
 
-def load_dids(file):
-    with open(file, 'r') as f:
-        lines = f.readlines()
 
+def get_client():
+    """
+    Returns the calling thread's Rucio client, creating it on first use.
+    """
+    if not hasattr(_local, "client"):
+        _local.client = Client()
+    return _local.client
+
+
+def load_dids(file):
     dids = []
-    for line in lines:
-        did = line.strip()
-        scope, name = did.split(':')
-        dids.append({
-            "scope": scope,
-            "name": name
-        })
+    with open(file, 'r') as f:
+        for line in f:
+            did = line.strip()
+            scope, name = did.split(':')
+            dids.append({
+                "scope": scope,
+                "name": name
+            })
     return dids
 
 
@@ -52,56 +64,63 @@ def parse_args():
     return args
 
 
+def scan(did):
+    """
+    Counts the states of a DID's rules and collects the stuck ones
+    """
+    rules = get_client().list_associated_rules_for_file(
+        scope=did['scope'],
+        name=did['name']
+    )
+    counts = collections.Counter()
+    stuck = []
+    for rule in rules:
+        counts[rule['state']] += 1
+        if rule['state'] == 'STUCK':
+            stuck.append(rule)
+    return counts, stuck
+
+
+def boost(rule, boost_rule):
+    """
+    Updates a stuck rule, optionally boosting it
+    """
+    get_client().update_replication_rule(
+        rule_id=rule['id'],
+        options={
+            'boost_rule': boost_rule
+        }
+    )
+
+
 def main(args):
     try:
         dids = load_dids(args.dids_file)
 
         total_rules = 0
-        total_ok = 0
-        total_stuck = 0
-        total_suspended = 0
-        total_replicating = 0
-        for did in dids:
-            rules = client.list_associated_rules_for_file(
-                scope=did['scope'],
-                name=did['name']
-            )
-            stuck = 0
-            suspended = 0
-            replicating = 0
-            ok = 0
-            for rule in rules:
-                total_rules += 1
-                if rule['state'] in ['STUCK']:
+        totals = collections.Counter()
+        stuck_rules = []
+        # Each DID is an independent Rucio call, so overlap them.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for did, (counts, stuck) in zip(dids, executor.map(scan, dids)):
+                total_rules += sum(counts.values())
+                totals.update(counts)
+                for rule in stuck:
                     print(rule)
-                    stuck += 1
-                    total_stuck += 1
-                    client.update_replication_rule(
-                        rule_id=rule['id'],
-                        options={
-                            'boost_rule': args.boost
-                        }
+                stuck_rules.extend(stuck)
+                if counts['STUCK'] > 0 or counts['SUSPENDED'] > 0:
+                    print(f"{did['scope']}:{did['name']}")
+                    msg = (
+                        f"Ok: {counts['OK']}, Stuck: {counts['STUCK']}, "
+                        f"Suspended: {counts['SUSPENDED']}, "
+                        f"Replicating: {counts['REPLICATING']}"
                     )
-                if rule['state'] in ['REPLICATING']:
-                    replicating += 1
-                    total_replicating += 1
-                if rule['state'] in ['SUSPENDED']:
-                    suspended += 1
-                    total_suspended += 1
-                if rule['state'] in ['OK']:
-                    ok += 1
-                    total_ok += 1
-            if stuck > 0 or suspended > 0:
-                print(f"{did['scope']}:{did['name']}")
-                msg = (
-                    f"Ok: {ok}, Stuck: {stuck}, "
-                    f"Suspended: {suspended}, Replicating: {replicating}"
-                )
-                print(msg)
+                    print(msg)
+            list(executor.map(lambda rule: boost(rule, args.boost), stuck_rules))
         print(f"Total rules: {total_rules}")
         msg = (
-            f"Ok: {total_ok}, Stuck: {total_stuck}, "
-            f"Suspended: {total_suspended}, Replicating: {total_replicating}"
+            f"Ok: {totals['OK']}, Stuck: {totals['STUCK']}, "
+            f"Suspended: {totals['SUSPENDED']}, Replicating: {totals['REPLICATING']}"
         )
         print(msg)
     except FileNotFoundError as e:
@@ -9,7 +9,17 @@ from rucio.client.replicaclient import ReplicaClient
 
 logging.basicConfig(level=logging.DEBUG)
 
-client = ReplicaClient()
+_client = None
+
+
+def get_client():
+    '''
+    Returns the replica client, creating it on first use
+    '''
+    global _client
+    if _client is None:
+        _client = ReplicaClient()
+    return _client
 
 
 def parse_args():
@@ -46,9 +56,9 @@ def main(args):
 
     logging.info("Declaring DIDs bad for %s", args.rse)
 
-    declared = client.declare_bad_did_replicas(rse=args.rse,
-                                               dids=bad_dids,
-                                               reason="recreated")
+    declared = get_client().declare_bad_did_replicas(rse=args.rse,
+                                                     dids=bad_dids,
+                                                     reason="recreated")
     logging.info("Declared bad %s", declared)
 
 
@@ -9,76 +9,125 @@ then uses the gfal client to get metadata from the PFNs.
 Copyright 2025 Fermi National Accelerator Laboratory (FNAL)
 '''
 import argparse
+import concurrent.futures
 import hashlib
+import itertools
 import json
 import pprint
+import threading
 
 import gfal2
 from rucio.client import Client
 
-client = Client()
-ctx = gfal2.creat_context()
-
 BASE_PFN = "davs://sdfdtn005.slac.stanford.edu:1094/lsst/rawdisk/raw/LSSTCam"
+MAX_WORKERS = 8
+CHUNK_SIZE = 500
+
+# Rucio clients and gfal2 contexts are not shared between threads.
+_local = threading.local()
+
+# adler32 checksums run here, alongside the md5 of the same file.
+checksum_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+def get_client():
+    """
+    Returns the calling thread's Rucio client, creating it on first use.
+    """
+    if not hasattr(_local, "client"):
+        _local.client = Client()
+    return _local.client
+
+
+def get_context():
+    """
+    Returns the calling thread's gfal2 context, creating it on first use.
+    """
+    if not hasattr(_local, "ctx"):
+        _local.ctx = gfal2.creat_context()
+    return _local.ctx
 
 
 def read_did_file(file: str):
     """
-    Reads a list of dids from a file that need updating.
+    Yields the dids from a file that need updating, one line at a time.
     """
-    dids = []
     with open(file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        for line in lines:
+        for line in f:
             if 'raw' in line:
                 did = line.split(' ')[0].strip()
                 print(did)
-                dids.append(did)
-    return dids
+                yield did
+
+
+def get_md5(pfn):
+    """
+    Gets the md5 checksum of a PFN, reading the file directly if gfal2 fails
+    """
+    try:
+        return get_context().checksum(pfn, 'md5')
+    except Exception:
+        filepath = pfn.replace(BASE_PFN,
+                               "/sdf/data/rubin/rses/lsst/rawdisk/raw/LSSTCam")
+        print(f"md5 failed for {pfn}, getting from {filepath}")
+
+        hash_md5 = hashlib.md5()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(4096), b""):
+                hash_md5.update(chunk)
+        return hash_md5.hexdigest()
+
+
+def get_file_metadata(replica, pfn):
+    """
+    Gets the size and checksums of a replica's PFN with gfal2
+    """
+    gfal_stat = get_context().stat(pfn)
+    gfal_size = gfal_stat.st_size
+    adler32 = checksum_pool.submit(
+        lambda: get_context().checksum(pfn, 'adler32'))
+    gfal_md5 = get_md5(pfn)
+    gfal_adler32 = adler32.result()
+
+    meta = {'name': replica['name'],
+            'scope': replica['scope'],
+            'adler32': gfal_adler32,
+            'md5': gfal_md5,
+            'bytes': gfal_size,
+            'old': {'adler32': replica['adler32'],
+                    'md5': replica['md5'],
+                    'bytes': replica['bytes']}}
+    pprint.pprint(meta)
+    return meta
 
 
 def gather_metadata(dids):
     """
     Gather metadata from Rucio and gfal2
     """
+    client = get_client()
     metadata = []
-    for did in dids:
-        scope, name = did.split(':')
-        did_meta = client.get_metadata(scope=scope, name=name)
-        print(did_meta)
-
-        replicas = client.list_replicas(dids=[{'scope': scope, 'name': name}],
-                                        rse_expression='SLAC_RAW_DISK')
-        for replica in replicas:
-            pfns = replica['pfns']
-            for pfn, info in pfns.items():
-                if info['rse'] == 'SLAC_RAW_DISK':
-                    gfal_stat = ctx.stat(pfn)
-                    gfal_size = gfal_stat.st_size
-                    try:
-                        gfal_md5 = ctx.checksum(pfn, 'md5')
-                    except Exception:
-                        filepath = pfn.replace(BASE_PFN,
-                                               "/sdf/data/rubin/rses/lsst/rawdisk/raw/LSSTCam")
-                        print(f"md5 failed for {pfn}, getting from {filepath}")
-
-                        hash_md5 = hashlib.md5()
-                        with open(filepath, "rb") as f:
-                            for chunk in iter(lambda: f.read(4096), b""):
-                                hash_md5.update(chunk)
-                        gfal_md5 = hash_md5.hexdigest()
-                    gfal_adler32 = ctx.checksum(pfn, 'adler32')
-
-                    meta = {'name': replica['name'],
-                            'scope': replica['scope'],
-                            'adler32': gfal_adler32,
-                            'md5': gfal_md5,
-                            'bytes': gfal_size,
-                            'old': {'adler32': replica['adler32'],
-                                    'md5': replica['md5'],
-                                    'bytes': replica['bytes']}}
-                    pprint.pprint(meta)
-                    metadata.append(meta)
+    dids = iter(dids)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Rucio is queried once per chunk of DIDs; only the gfal2 work is
+        # done per PFN, overlapped across files since it is dominated by
+        # storage latency.
+        while chunk := list(itertools.islice(dids, CHUNK_SIZE)):
+            chunk_dids = []
+            for did in chunk:
+                scope, name = did.split(':')
+                chunk_dids.append({'scope': scope, 'name': name})
+            for did_meta in client.get_metadata_bulk(
+                    dids=chunk_dids, plugin='DID_COLUMN'):
+                print(did_meta)
+
+            replicas = client.list_replicas(dids=chunk_dids,
+                                            rse_expression='SLAC_RAW_DISK')
+            files = [(replica, pfn)
+                     for replica in replicas
+                     for pfn, info in replica['pfns'].items()
+                     if info['rse'] == 'SLAC_RAW_DISK']
+            metadata.extend(executor.map(lambda f: get_file_metadata(*f), files))
     return metadata
 
 
@@ -18,95 +18,241 @@ the script.
 Copyright 2025 Fermi National Accelerator Laboratory (FNAL)
 """
 import argparse
+import concurrent.futures
+import functools
+import itertools
 import json
 import logging
+import time
 
+import sqlalchemy.exc
+from rucio.common.exception import DatabaseException
 from rucio.core import did
 from rucio.common.types import InternalScope
+from rucio.db.sqla.session import transactional_session
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
-logging.basicConfig(level=logging.DEBUG)
 
+logger = logging.getLogger(__name__)
 
-def update_did(scope: InternalScope,
-               name: str,
-               adler32: str,
-               md5: str,
-               filesize):
+CHUNK_SIZE = 1000
+VERIFY_CHUNK_SIZE = 500
+VERIFY_WORKERS = 16
+# Verification queries allowed to be outstanding while later chunks are
+# being updated.
+MAX_PENDING_VERIFY = 2 * VERIFY_WORKERS
+MAX_RETRIES = 5
+
+# Connection and timeout errors are worth retrying the same bulk update
+# for; anything else is taken to be caused by one of the DIDs in it.
+TRANSIENT_ERRORS = (
+    sqlalchemy.exc.DisconnectionError,
+    sqlalchemy.exc.TimeoutError,
+)
+# Rucio turns every database error into a DatabaseException, so lost
+# connections and timeouts are recognised from the message.
+TRANSIENT_MESSAGES = (
+    'server closed the connection unexpectedly',
+    'could not connect to server',
+    'connection timed out',
+    'statement timeout',
+    'Lost connection to MySQL server',
+    'ORA-03113',
+    'ORA-03114',
+    'ORA-03135',
+    'ORA-12170',
+)
+
+
+@functools.cache
+def get_scope(scope: str) -> InternalScope:
+    """
+    Returns the InternalScope for a scope name, made once per scope
+    """
+    return InternalScope(scope=scope)
+
+
+def update_dids_bulk(dids):
+    """
+    Updates the adler32, bytes, and md5 of many dids in a single transaction
+
+    Each entry is a dict with the did's InternalScope, name, and the new
+    metadata under 'meta'.
+    """
+    if hasattr(did, 'set_dids_metadata_bulk'):
+        did.set_dids_metadata_bulk(dids=dids)
+    else:
+        update_dids_in_session(dids)
+
+
+def is_transient(error):
+    """
+    Returns whether an error is a lost connection or a timeout
+    """
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if isinstance(error, sqlalchemy.exc.DBAPIError):
+        return error.connection_invalidated
+    if isinstance(error, DatabaseException):
+        message = str(error)
+        return any(m in message for m in TRANSIENT_MESSAGES)
+    return False
+
+
+def with_retries(label, func, *args, **kwargs):
+    """
+    Calls func, retrying transient database errors with exponential backoff
+
+    The error is raised again once MAX_RETRIES retries have failed, or
+    straight away if it is not transient.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not is_transient(e) or attempt == MAX_RETRIES:
+                raise
+            delay = 2 ** attempt
+            logger.warning("%s failed, retry %s in %ss: %s",
+                           label, attempt + 1, delay, e)
+            time.sleep(delay)
+
+
+def update_with_split(pending):
     """
-    Updates a did's adler32, bytes, and md5 given the scope and name
+    Bulk updates (entry, correction) pairs, isolating the ones that fail
+
+    Transient database errors are retried with exponential backoff; if
+    they outlast the retries the whole chunk fails, since a lost database
+    is not caused by any one DID. Any other error splits the pairs in half
+    and updates each half separately, until the failing DIDs are on their
+    own.
+
+    Returns the pairs that were updated and the pairs that failed.
+    """
+    try:
+        with_retries(f"Bulk update of {len(pending)} DIDs",
+                     update_dids_bulk, [entry for entry, _ in pending])
+        return pending, []
+    except Exception as e:
+        if is_transient(e):
+            logger.error("Bulk update of %s DIDs failed after %s retries: %s",
+                         len(pending), MAX_RETRIES, e)
+            return [], pending
+        error = e
+
+    if len(pending) == 1:
+        _, file = pending[0]
+        logger.error("DID %s:%s update failed due to %s",
+                     file['scope'], file['name'], error)
+        return [], pending
+
+    logger.warning("Bulk update of %s DIDs failed, splitting it: %s",
+                   len(pending), error)
+    half = len(pending) // 2
+    first_applied, first_failed = update_with_split(pending[:half])
+    second_applied, second_failed = update_with_split(pending[half:])
+    return (first_applied + second_applied,
+            first_failed + second_failed)
+
+
+@transactional_session
+def update_dids_in_session(dids, *, session=None):
+    """
+    Updates many dids one at a time, sharing a single transaction
+
+    For Rucio versions without set_dids_metadata_bulk.
     """
-    meta = {
-        'adler32': adler32,
-        'bytes': filesize,
-        'md5': md5
-    }
-    did.set_metadata_bulk(scope=scope, name=name, meta=meta)
+    for entry in dids:
+        did.set_metadata_bulk(scope=entry['scope'], name=entry['name'],
+                              meta=entry['meta'], session=session)
 
 
-def get_metadata(scope, name):
+def fetch_metadata(dids):
     """
-    Fetches the metadata of a did from the name and scope
+    Fetches the metadata of dids in one query, as a list
     """
-    current = did.get_metadata(scope=scope, name=name)
-    return current
+    return list(did.get_metadata_bulk(dids=dids))
+
+
+def get_metadata_bulk(dids, chunk=1000):
+    """
+    Fetches the metadata of many dids, a chunk of dids per query
+
+    Returns a dict keyed by the (internal scope, name) of each did found.
+    """
+    metadata = {}
+    for i in range(0, len(dids), chunk):
+        part = dids[i:i + chunk]
+        rows = with_retries(f"Metadata query of {len(part)} DIDs",
+                            fetch_metadata, part)
+        for meta in rows:
+            metadata[(meta['scope'].internal, meta['name'])] = meta
+    return metadata
+
+
+def did_key(entry):
+    """
+    Returns the key of a did in the dict from get_metadata_bulk
+    """
+    return (entry['scope'].internal, entry['name'])
 
 
 def load_metadata():
     """
-    Legacy. Loads metadata from files
-    """
-    metadata = ['adler32', 'filesize', 'md5']
-    file_data = {}
-    for m in metadata:
-        with open(f'{m}.73.txt', 'r') as f:
-            file_data[m] = f.readlines()
-    metadata_val = []
-    for adler32, md5, filesize in zip(file_data['adler32'],
-                                      file_data['md5'],
-                                      file_data['filesize']):
-        adler_scope, rucio_adler, butler_adler = adler32.strip().split(' ')
-        md5_scope, rucio_md5, butler_md5 = md5.strip().split(' ')
-        (filesize_scope,
-         rucio_filesize,
-         butler_filesize) = filesize.strip().split(' ')
-
-        if adler_scope == md5_scope and adler_scope == filesize_scope:
-            scope, name = adler_scope.split(':')
-            meta = {
-                "name": name,
-                "scope": scope,
-                "adler32": butler_adler,
-                "md5": butler_md5,
-                "bytes": int(butler_filesize),
-                "old": {
-                    "adler32": rucio_adler,
-                    "md5": rucio_md5,
-                    "bytes": int(rucio_filesize),
-                }
-            }
-            metadata_val.append(meta)
+    Legacy. Yields metadata from files, reading them line by line
+    """
+    with open('adler32.73.txt', 'r') as adler32_file, \
+         open('md5.73.txt', 'r') as md5_file, \
+         open('filesize.73.txt', 'r') as filesize_file:
+        for adler32, md5, filesize in zip(adler32_file, md5_file,
+                                          filesize_file):
+            adler_scope, rucio_adler, butler_adler = adler32.strip().split(' ')
+            md5_scope, rucio_md5, butler_md5 = md5.strip().split(' ')
+            (filesize_scope,
+             rucio_filesize,
+             butler_filesize) = filesize.strip().split(' ')
 
-    return metadata_val
+            if adler_scope == md5_scope and adler_scope == filesize_scope:
+                scope, name = adler_scope.split(':')
+                yield {
+                    "name": name,
+                    "scope": scope,
+                    "adler32": butler_adler,
+                    "md5": butler_md5,
+                    "bytes": int(butler_filesize),
+                    "old": {
+                        "adler32": rucio_adler,
+                        "md5": rucio_md5,
+                        "bytes": int(rucio_filesize),
+                    }
+                }
 
 
-def verify_metadata(a: dict, b: dict) -> bool:
+def metadata_triple(meta: dict) -> tuple:
     """
-    Verify if metadata matches between dicts
+    Returns the (adler32, md5, bytes) of a metadata dict for comparison
     """
-    for k, v in a.items():
-        if v != b[k]:
-            return False
-    return True
+    return (meta['adler32'], meta['md5'], meta['bytes'])
 
 
-def load_from_json(file):
+def iter_corrections(file):
     '''
-    Loads corrections file from JSON
+    Yields the corrections from a JSON file one at a time
+
+    The file is parsed incrementally with ijson when it is installed, so
+    large corrections files are never held in memory all at once.
     '''
-    with open(file, 'r') as f:
-        dids = json.load(f)
-    return dids
+    if ijson is None:
+        with open(file, 'r') as f:
+            yield from json.load(f)
+        return
+    with open(file, 'rb') as f:
+        yield from ijson.items(f, 'item', use_float=True)
 
 
 def parse_args():
@@ -122,64 +268,184 @@ def parse_args():
         help='JSON file with DID corrections'
     )
 
+    parser.add_argument(
+        '--log-level',
+        type=str.upper,
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='Logging level (default: INFO)'
+    )
+
     args = parser.parse_args()
 
     return args
 
 
-def main(args):
-    dids = load_from_json(args.corrections_file)
-    logging.info("Number of DIDs to update: %s", len(dids))
+def update_chunk(dids, executor, futures):
+    """
+    Updates a chunk of DIDs from the corrections file
 
-    to_update = 0
+    The queries verifying the updates are submitted to the executor and
+    added to futures, mapped to the (entry, correction) pairs they check,
+    without waiting for them.
+
+    Returns the number of DIDs to update and the corrections that failed.
+    """
+    # Corrections whose old and new metadata are identical are no-ops and
+    # need no database access at all.
+    nontrivial = [file for file in dids
+                  if metadata_triple(file['old']) != metadata_triple(file)]
+    if len(nontrivial) < len(dids):
+        logger.info("Skipping %s DIDs whose old and new metadata match",
+                    len(dids) - len(nontrivial))
+    dids = nontrivial
+
+    # Build the list of updates, one per DID in the corrections file.
+    entries = [{
+        'scope': get_scope(file['scope']),
+        'name': file['name'],
+        'meta': {
+            'adler32': file['adler32'],
+            'bytes': file['bytes'],
+            'md5': file['md5']
+        }
+    } for file in dids]
+
+    # Fetch the current metadata of every DID before changing anything.
+    try:
+        current = get_metadata_bulk([{'scope': entry['scope'],
+                                      'name': entry['name']}
+                                     for entry in entries])
+    except Exception as e:
+        logger.error("Metadata query of %s DIDs failed due to %s",
+                     len(entries), e)
+        return len(entries), dids
+
+    # Only update DIDs whose current metadata matches the old metadata.
+    pending = []
+    for entry, file in zip(entries, dids):
+        current_metadata = current.get(did_key(entry))
+        if current_metadata is None:
+            logger.info("DID %s:%s not found, skipping",
+                        file['scope'], file['name'])
+            continue
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Current metadata for %s:%s: %s", file['scope'],
+                         file['name'], current_metadata)
+        current_vals = metadata_triple(current_metadata)
+        if current_vals == metadata_triple(file['old']):
+            logger.info("Updating %s:%s", file['scope'], file['name'])
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("New metadata for %s:%s: %s",
+                             file['scope'], file['name'], file)
+            pending.append((entry, file))
+        elif current_vals == metadata_triple(file):
+            logger.info("DID %s:%s already updated, skipping",
+                        file['scope'], file['name'])
+        else:
+            logger.info(("DID %s:%s metadata doesn't match provided "
+                         "old metadata, skipping"),
+                        file['scope'], file['name'])
+
+    to_update = len(pending)
+    pending, failed_pairs = update_with_split(pending)
+    failed = [file for _, file in failed_pairs]
+
+    # Check that every update has been applied, fetching the metadata
+    # of each part of the chunk in parallel.
+    for i in range(0, len(pending), VERIFY_CHUNK_SIZE):
+        part = pending[i:i + VERIFY_CHUNK_SIZE]
+        future = executor.submit(get_metadata_bulk,
+                                 [{'scope': entry['scope'],
+                                   'name': entry['name']}
+                                  for entry, _ in part])
+        futures[future] = part
+
+    return to_update, failed
+
+
+def count_verified(part, updated_by_key):
+    """
+    Compares the updated metadata of a part of a chunk with the corrections
+
+    Returns the number of DIDs that were updated.
+    """
     updated = 0
-    failed = []
-    for file in dids:
-        logging.info("Updating %s:%s with metadata: %s",
-                     file['scope'], file['name'], file)
-        scope = InternalScope(scope=file['scope'])
-        current_metadata = get_metadata(scope, file['name'])
-        logging.debug("Current metadata for %s:%s: %s", file['scope'],
-                      file['name'], file)
-        current_vals = {k: v for k, v in current_metadata.items()
-                        if k in ['adler32', 'md5', 'bytes']}
-        if verify_metadata(current_vals, file['old']):
+    for entry, file in part:
+        updated_metadata = updated_by_key.get(did_key(entry))
+        if updated_metadata is None:
+            logger.info("Failed to update or dry run")
+            continue
+        if metadata_triple(updated_metadata) == metadata_triple(file):
+            updated += 1
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Updated metadata: %s", updated_metadata)
+            logger.info("DID %s:%s updated",
+                        file['scope'], file['name'])
+        else:
+            logger.info("Failed to update or dry run")
+    return updated
+
+
+def drain_verified(futures, limit, failed):
+    """
+    Waits for verification queries until at most limit are outstanding
+
+    Corrections whose metadata could not be fetched back are added to
+    failed. Returns the number of DIDs verified as updated.
+    """
+    updated = 0
+    while len(futures) > limit:
+        done, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            part = futures.pop(future)
             try:
-                to_update += 1
-                update_did(scope, file['name'], file['adler32'],
-                           file['md5'], file['bytes'])
+                updated_by_key = future.result()
             except Exception as e:
-                logging.error("DID %s:%s update failed due to %s",
-                              file['scope'], file['name'], e)
-                failed.append(file)
+                logger.error("Could not verify %s DIDs due to %s",
+                             len(part), e)
+                failed.extend(file for _, file in part)
                 continue
-            updated_metadata = get_metadata(scope, file['name'])
-            updated_vals = {k: v for k, v in updated_metadata.items()
-                            if k in ['adler32', 'md5', 'bytes']}
-            if verify_metadata(updated_vals, file):
-                updated += 1
-                logging.info("Updated metadata: ", updated_metadata)
-                logging.info("DID %s:%s updated", file['scope'], file['name'])
-            else:
-                logging.info("Failed to update or dry run")
-        else:
-            if verify_metadata(current_vals, file):
-                logging.info("DID %s:%s already updated, skipping",
-                             file['scope'], file['name'])
-            else:
-                logging.info(("DID %s:%s metadata doesn't match provided "
-                              "old metadata, skipping"),
-                             file['scope'], file['name'])
+            updated += count_verified(part, updated_by_key)
+    return updated
+
+
+def main(args):
+    corrections = iter_corrections(args.corrections_file)
+
+    total = 0
+    to_update = 0
+    updated = 0
+    failed = []
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=VERIFY_WORKERS) as executor:
+        # Verification of earlier chunks overlaps with the updates of
+        # later ones, up to MAX_PENDING_VERIFY outstanding queries.
+        while dids := list(itertools.islice(corrections, CHUNK_SIZE)):
+            chunk_to_update, chunk_failed = update_chunk(dids, executor,
+                                                         futures)
+            total += len(dids)
+            to_update += chunk_to_update
+            failed.extend(chunk_failed)
+            updated += drain_verified(futures, MAX_PENDING_VERIFY,
+                                      failed)
+            logger.info("Processed %s DIDs, %s updated, %s verified so far",
+                        total, to_update - len(failed), updated)
+        updated += drain_verified(futures, 0, failed)
 
-    logging.info(("Number of DIDs to update: %s,"
-                  "Number of updated DIDs: %s, "
-                  "Number of failed updates: %s"),
-                 to_update,
-                 updated, failed)
+    logger.info(("Number of DIDs in corrections file: %s, "
+                 "Number of DIDs to update: %s, "
+                 "Number of updated DIDs: %s, "
+                 "Number of failed updates: %s"),
+                total, to_update,
+                updated, failed)
 
 
 if __name__ == '__main__':
     args = parse_args()
+    logging.basicConfig(level=args.log_level)
     try:
         main(args)
     except FileNotFoundError as e: